@@ -1,11 +1,13 @@
+import datetime
 import traceback
-from functools import wraps
+from functools import lru_cache, wraps
 
 import cfg4py
 import numpy as np
 from coretypes.errors.trade import TradeError
 from expiringdict import ExpiringDict
 from omicron.core.backtestlog import BacktestLogger
+from omicron.models.timeframe import TimeFrame as tf
 from sanic import Sanic, response
 from tabulate import tabulate
 
@@ -167,6 +169,25 @@ def jsonify(obj) -> dict:
         raise ValueError(f"{obj} is not jsonable")
 
 
+class LazyFormat:
+    """延迟求值的日志参数
+
+    日志参数在调用`logger.info`等方法时就会被求值，即使该级别的日志最终并不输出。将耗时的格式化操作包装为`LazyFormat`对象后，只有在handler真正格式化该条日志时，才会调用`func`。
+
+    Example:
+        >>> logger.info("持仓: %s", LazyFormat(tabulate_numpy_array, position))
+    """
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+
 def tabulate_numpy_array(arr: np.ndarray) -> str:
     """将numpy structured array 格式化为表格对齐的字符串
 
@@ -178,3 +199,49 @@ def tabulate_numpy_array(arr: np.ndarray) -> str:
     """
     table = tabulate(arr, headers=arr.dtype.names, tablefmt="fancy_grid")
     return table
+
+
+def price_to_ticks(prices) -> np.ndarray:
+    """将价格转换为以最小变动价位(0.01元)为单位的整数
+
+    A股的最小价格变动单位是0.01元，因此两个价格相等，当且仅当它们的tick数相等。与浮点数容差比较相比，整数比较是精确的，且只需要取整一次。
+
+    Args:
+        prices : 价格，可以是标量或者numpy数组
+
+    Returns:
+        dtype为int64的tick数。
+    """
+    return np.rint(np.asarray(prices, dtype=np.float64) * 100).astype(np.int64)
+
+
+@lru_cache(maxsize=4096)
+def count_day_frames(start: datetime.date, end: datetime.date) -> int:
+    """带缓存的[tf.count_day_frames][omicron.models.timeframe.TimeFrame.count_day_frames]
+
+    交易日历在服务运行期间不会改变，因此结果只取决于`start`和`end`。
+
+    Args:
+        start: 起始日期
+        end: 结束日期
+
+    Returns:
+        [start, end]间的交易日数
+    """
+    return tf.count_day_frames(start, end)
+
+
+class SlotsStateMixin:
+    """为使用了`__slots__`的类提供pickle状态恢复
+
+    加入`__slots__`之前保存的回测，其state为对象的`__dict__`；加入之后，state为`(None, slots)`的元组。两者都可以通过本类的`__setstate__`恢复。
+    """
+
+    __slots__ = ()
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **state[1]}
+
+        for k, v in state.items():
+            setattr(self, k, v)
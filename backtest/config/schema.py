@@ -27,6 +27,9 @@ class Config(object):
 
         annual_days: Optional[int] = None
 
+    class events:
+        batch: Optional[bool] = None
+
     class server:
         prefix: Optional[str] = None
 
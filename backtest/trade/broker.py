@@ -7,10 +7,10 @@ Broker是一个交易代理。每一个交易代理对应一个账户，记录
 * get_assets
 """
 import asyncio
+import bisect
 import datetime
 import logging
-import uuid
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Dict, Final, List, Optional, Tuple, Union
 
 import arrow
 import cfg4py
@@ -31,23 +31,21 @@ from coretypes.errors.trade import (
     VolumeNotMeet,
 )
 from deprecation import deprecated
-from empyrical import (
-    annual_return,
-    annual_volatility,
-    calmar_ratio,
-    cum_returns_final,
-    max_drawdown,
-    sharpe_ratio,
-    sortino_ratio,
-)
 from numpy.typing import NDArray
 from omicron.core.backtestlog import BacktestLogger
-from omicron.extensions import array_math_round, array_price_equal, math_round
+from omicron.extensions import math_round
 from omicron.models.stock import Stock
 from omicron.models.timeframe import TimeFrame as tf
 from pyemit import emit
 
-from backtest.common.helper import get_app_context, jsonify, tabulate_numpy_array
+from backtest.common.helper import (
+    LazyFormat,
+    count_day_frames,
+    get_app_context,
+    jsonify,
+    price_to_ticks,
+    tabulate_numpy_array,
+)
 from backtest.trade.datatypes import (
     E_BACKTEST,
     BidType,
@@ -57,9 +55,12 @@ from backtest.trade.datatypes import (
     cash_dtype,
     daily_position_dtype,
     float_ts_dtype,
+    next_eid,
     position_dtype,
     rich_assets_dtype,
 )
+from backtest.trade.matching import filter_bars, match_bid
+from backtest.trade.metrics import returns_metrics
 from backtest.trade.trade import Trade
 from backtest.trade.transaction import Transaction
 
@@ -68,6 +69,25 @@ logger = BacktestLogger.getLogger(__name__)
 entrustlog = logging.getLogger("entrust")
 tradelog = logging.getLogger("trade")
 
+# 没有配对交易时的指标
+_EMPTY_METRICS: Final = {
+    "start": None,
+    "end": None,
+    "window": None,
+    "total_tx": 0,
+    "total_profit": None,
+    "total_profit_rate": None,
+    "win_rate": None,
+    "mean_return": None,
+    "sharpe": None,
+    "sortino": None,
+    "calmar": None,
+    "max_drawdown": None,
+    "annual_return": None,
+    "volatility": None,
+    "baseline": None,
+}
+
 
 class Broker:
     def __init__(
@@ -114,7 +134,19 @@ class Broker:
 
         # 初始本金
         self.principal = principal
-        self._unclosed_trades: Dict[datetime.date, List[str]] = {}  # 未平仓的交易
+
+        # 计算指标时使用的年化天数和无风险日利率。各配置项缺失时分别使用默认值，
+        # 但配置了非法的值时将抛出异常
+        metrics_cfg = getattr(cfg, "metrics", None)
+        self._annual_days = int(getattr(metrics_cfg, "annual_days", 252))
+        self._rf = (
+            float(getattr(metrics_cfg, "risk_free_rate", 0.0)) / self._annual_days
+        )
+
+        # 未平仓的交易。只会按日期递增的顺序插入，因此第一个和最后一个键即为最早和最晚的日期
+        self._unclosed_trades: Dict[datetime.date, List[str]] = {}
+        # 同上，但按证券分组，卖出时只需遍历该证券的未平仓交易
+        self._unclosed_by_sec: Dict[datetime.date, Dict[str, List[str]]] = {}
 
         # 委托列表，包括废单和未成交委托
         self.entrusts = {}
@@ -125,8 +157,31 @@ class Broker:
         # trasaction = buy + sell trade
         self.transactions: List[Transaction] = []
 
+        # 与transactions一一对应的买入日、卖出日和盈亏，用以在metrics中进行向量化计算
+        self._tx_entry_days: List[np.datetime64] = []
+        self._tx_exit_days: List[np.datetime64] = []
+        self._tx_profits: List[float] = []
+        self._tx_arrays: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+        # get_returns的缓存，(start, end) -> 每日回报。资产表只会被整体替换，不会原地修改，
+        # 因此当self._assets不再是_returns_cache_of时，缓存即失效
+        self._returns_cache: Dict[Tuple[datetime.date, datetime.date], NDArray] = {}
+        self._returns_cache_of: Optional[np.ndarray] = None
+
         self._lock = asyncio.Lock()
 
+        # (security, date) -> 当日涨跌停价。同一交易日内多次委托同一证券时无须重复查询
+        self._price_limits: Dict[Tuple[str, datetime.date], Tuple] = {}
+
+        # 当日已查询过的收盘价，见_get_day_closes
+        self._closes_date: Optional[datetime.date] = None
+        self._closes: Dict[str, float] = {}
+
+        # 是否按交易日批量发送E_BACKTEST事件，由配置项events.batch决定。批量发送时，
+        # 待发送的事件缓存在_events中，以减少emit的往返次数
+        self._batch_events = bool(getattr(getattr(cfg, "events", None), "batch", False))
+        self._events: List[dict] = []
+
     @deprecated("since 0.5.0, pickle bills and metrics instead")
     def __getstate__(self):
         # self._lock is not pickable
@@ -142,6 +197,10 @@ class Broker:
 
     @property
     def lock(self):
+        """串行化同一账户的委托
+
+        不同账户各自持有一把锁，互不阻塞。同一账户的buy/sell在临界区内会等待feed返回数据，此时同一账户的其它请求可能被调度执行，从而交错修改现金表和持仓表，因此这把锁不能移除。锁在无竞争时的获取/释放不会让出事件循环，开销可以忽略。
+        """
         return self._lock
 
     @property
@@ -170,11 +229,11 @@ class Broker:
         if dt < self.bt_start:
             raise BadParamsError(f"dt should be later than start {self.bt_start}")
 
-        ipos = np.argwhere(dt >= self._cash["date"]).flatten()
-        if len(ipos) == 0:
+        # 现金表按日期递增排列，二分查找最后一个不晚于`dt`的记录
+        ipos = bisect.bisect_right(self._cash["date"], dt) - 1
+        if ipos < 0:
             return self.principal
 
-        ipos = ipos[-1]
         return self._cash[ipos]["cash"].item()
 
     def get_unclosed_trades(self, dt: datetime.date) -> List[str]:
@@ -187,7 +246,7 @@ class Broker:
 
         result = self._unclosed_trades.get(dt)
         if result is None:
-            start = sorted(self._unclosed_trades.keys())[0]
+            start = next(iter(self._unclosed_trades))
             if dt < start:
                 return []
             else:
@@ -211,38 +270,54 @@ class Broker:
         if dt < self._positions[0]["date"]:
             return np.array([], dtype=dtype)
 
-        last_date = np.max(self._positions["date"])
+        last_date = self._positions[-1]["date"]
         if dt > last_date:
-            filter = (self._positions["date"] == last_date) & (
-                self._positions["security"] != None  # noqa: E711
-            )
-            result = self._positions[filter]
+            result = self._positions_on(last_date)
             result["sellable"] = result["shares"]
             return result[list(dtype.names)].astype(dtype)  # type: ignore
 
-        filter = (self._positions["date"] == dt) & (
-            self._positions["security"] != None  # noqa: E711
-        )
-        result = self._positions[filter]
+        result = self._positions_on(dt)
 
         return result[list(dtype.names)].astype(dtype)  # type: ignore
 
+    def _positions_range(self, start: datetime.date, end: datetime.date) -> slice:
+        """持仓表中日期在[start, end]之间的记录所在的区间
+
+        持仓表按日期递增排列，同一天的记录是连续的，因此通过二分查找即可定位。
+        """
+        dates = self._positions["date"]
+        lo = bisect.bisect_left(dates, start)
+        hi = bisect.bisect_right(dates, end, lo)
+        return slice(lo, hi)
+
+    def _positions_on(self, dt: datetime.date) -> np.ndarray:
+        """取持仓表中`dt`日的记录，不包括security为None的占位记录
+
+        返回的是副本，可以修改。
+        """
+        block = self._positions[self._positions_range(dt, dt)]
+        return block[block["security"] != None]  # noqa: E711
+
     async def _query_market_values(
         self, start: datetime.date, end: datetime.date
     ) -> pd.Series:
         frames = [tf.int2date(d) for d in tf.get_frames(start, end, FrameType.DAY)]
 
-        filter = (self._positions["date"] >= start) & (self._positions["date"] <= end)
-        secs = list(set(self._positions[filter]["security"]))
+        held = self._positions[self._positions_range(start, end)]
+
+        # 占位记录(security为None)和已清仓的记录市值为零，无须查询收盘价
+        secs = list(set(held[held["shares"] != 0]["security"]))
 
-        if len(secs):
+        if len(secs) and start == end:
+            df_prices = await self._get_day_closes(secs, start)
+        elif len(secs):
             feed = get_app_context().feed
             df_prices = await feed.batch_get_close_price_in_range(secs, start, end)
         else:
             df_prices = pd.DataFrame([], index=frames)
 
         # 1. get shares of each day in range [start, end]
-        df_shares = pd.DataFrame(data=self._positions[filter]).pivot(
+        df_shares = pd.DataFrame(data=held).pivot(
             columns="security", index="date", values="shares"
         )
 
@@ -251,6 +326,24 @@ class Broker:
         mv = df_prices.multiply(df_shares).sum(axis=1)
         return mv
 
+    async def _get_day_closes(self, secs: List[str], dt: datetime.date) -> pd.DataFrame:
+        """查询`secs`在`dt`日的收盘价
+
+        同一交易日内每次成交都会更新当日资产，此时只有新买入的证券需要查询收盘价，其余的取自缓存。
+        """
+        if self._closes_date != dt:
+            self._closes_date = dt
+            self._closes = {}
+
+        missing = [sec for sec in secs if sec not in self._closes]
+        if len(missing):
+            feed = get_app_context().feed
+            df = await feed.batch_get_close_price_in_range(missing, dt, dt)
+            for sec in missing:
+                self._closes[sec] = df[sec].iloc[-1] if sec in df else np.nan
+
+        return pd.DataFrame({sec: [self._closes[sec]] for sec in secs}, index=[dt])
+
     async def _forward_assets(self, end: datetime.date):
         """更新资产表
 
@@ -281,8 +374,10 @@ class Broker:
         # 待补齐的资产日
         mv = await self._query_market_values(start, end)
         # cash + mv
-        filter = (self._cash["date"] >= start) & (self._cash["date"] <= end)
-        assets = mv + self._cash[filter]["cash"]
+        dates = self._cash["date"]
+        lo = bisect.bisect_left(dates, start)
+        hi = bisect.bisect_right(dates, end, lo)
+        assets = mv + self._cash[lo:hi]["cash"]
 
         self._assets = np.append(
             self._assets[:-1],  # 最后一行是重叠的
@@ -319,6 +414,8 @@ class Broker:
             - positions: 当前持仓，dtype为position_dtype的numpy structured array
 
         """
+        await self.flush_events()
+
         dt = dt or self.last_trade_date or self.bt_start
 
         cash = self.get_cash(dt)
@@ -351,7 +448,7 @@ class Broker:
             end_date : 计算回报的结束日期
 
         Returns:
-            以百分比为单位的每日回报率,索引为对应日期
+            以百分比为单位的每日回报率,索引为对应日期。返回的数组会被缓存，调用者不应修改它
         """
         start = start_date or self.bt_start
         end = end_date or self.bt_end
@@ -359,10 +456,19 @@ class Broker:
         assert self.bt_start <= start <= end
         assert start <= end <= self.bt_end
 
-        istart = np.argwhere(start >= self._assets["date"]).flatten()[-1]
+        if self._returns_cache_of is not self._assets:
+            self._returns_cache = {}
+            self._returns_cache_of = self._assets
+
+        cached = self._returns_cache.get((start, end))
+        if cached is not None:
+            return cached
+
+        dates = self._assets["date"]
+        istart = bisect.bisect_right(dates, start) - 1
         if istart > 0:
             istart -= 1
-        iend = np.argwhere(end >= self._assets["date"]).flatten()[-1]
+        iend = bisect.bisect_right(dates, end) - 1
         if istart >= iend:
             raise TradeError(
                 f"date range error: {start} - {end} contains no data", with_stack=True
@@ -370,7 +476,10 @@ class Broker:
 
         # it's ok if iend + 1 > len(self._assets)
         assets = self._assets[istart : iend + 1]["assets"]
-        return assets[1:] / assets[:-1] - 1
+        returns = assets[1:] / assets[:-1] - 1
+
+        self._returns_cache[(start, end)] = returns
+        return returns
 
     @property
     def assets(self) -> float:
@@ -400,11 +509,8 @@ class Broker:
         if date > last:
             # 使用最后一天的持仓，last~date之间的收盘价计算每日市值，再加上现金
             # 因此这里不能使用_query_market_values
-            filter = (self._positions["date"] == last) & (
-                self._positions["security"] != None  # noqa: E711
-            )
-
-            secs = self._positions[filter]["security"]
+            held = self._positions_on(last)
+            secs = held["security"]
 
             if len(secs) == 0:  # 无持仓
                 return self._cash[-1]["cash"]
@@ -412,7 +518,7 @@ class Broker:
             feed = get_app_context().feed
             df_prices = await feed.batch_get_close_price_in_range(secs, last, date)
 
-            df_shares = pd.DataFrame(data=self._positions[filter]).pivot(
+            df_shares = pd.DataFrame(data=held).pivot(
                 columns="security", index="date", values="shares"
             )
 
@@ -421,9 +527,9 @@ class Broker:
 
             return mv.iloc[-1] + self._cash[-1]["cash"]
         else:
-            pos = np.argwhere(date >= self._assets["date"]).flatten()
-            if len(pos) > 0:
-                return self._assets[pos[-1]]["assets"].item()
+            pos = bisect.bisect_right(self._assets["date"], date) - 1
+            if pos >= 0:
+                return self._assets[pos]["assets"].item()
             else:  # 日期小于回测起始日
                 return self.principal
 
@@ -503,14 +609,7 @@ class Broker:
         Returns:
             返回dtype为[position_dtype][backtest.trade.datatypes.position_dtype]的numpy structure array
         """
-        if self._positions.size == 0:
-            return np.array([], dtype=position_dtype)
-
-        last_day = self._positions[-1]["date"]
-        filter = (self._positions["date"] == last_day) & (
-            self._positions["security"] != None  # noqa: E711
-        )
-        result = self._positions[filter]
+        result = self._positions_on(self._positions[-1]["date"])
 
         return result[list(position_dtype.names)].astype(position_dtype)  # type: ignore
 
@@ -610,7 +709,12 @@ class Broker:
         bid_time: datetime.datetime,
     ) -> Trade:
         entrustlog.info(
-            f"{bid_time}\t{security}\t{bid_shares}\t{bid_price}\t{EntrustSide.BUY}"
+            "%s\t%s\t%s\t%s\t%s",
+            bid_time,
+            security,
+            bid_shares,
+            bid_price,
+            EntrustSide.BUY,
         )
         assert (
             type(bid_time) is datetime.datetime
@@ -640,7 +744,7 @@ class Broker:
 
         self.entrusts[en.eid] = en
 
-        _, buy_limit_price, sell_limit_price = await feed.get_trade_price_limits(
+        _, buy_limit_price, sell_limit_price = await self._get_trade_price_limits(
             security, bid_time.date()
         )
 
@@ -659,13 +763,9 @@ class Broker:
             security, bid_time, bars, bid_price, buy_limit_price, sell_limit_price
         )
 
-        # 将买入数限制在可用资金范围内
-        shares_to_buy = min(
-            bid_shares, self.cash // (bid_price * (1 + self.commission))
-        )
-
-        # 必须以手为单位买入，否则委托会失败
-        shares_to_buy = shares_to_buy // 100 * 100
+        # 将买入数限制在可用资金范围内。必须以手为单位买入，否则委托会失败
+        affordable_lots = self.cash // (bid_price * (1 + self.commission) * 100)
+        shares_to_buy = min(bid_shares // 100, affordable_lots) * 100
         if shares_to_buy < 100:
             logger.info("委买失败：%s, 资金(%s)不足购买1手。", security, self.cash, date=bid_time)
             raise CashError(
@@ -693,37 +793,26 @@ class Broker:
         Returns:
             成交均价、可埋单股数和最后成交时间
         """
-        c, v = bid_queue["price"], bid_queue["volume"]
-
-        cum_v = np.cumsum(v)
-
-        # until i the order can be filled
-        where_total_filled = np.argwhere(cum_v >= shares_to_bid)
-        if len(where_total_filled) == 0:
-            i = len(v) - 1
-        else:
-            i = np.min(where_total_filled)
-
-        # 也许到当天结束，都没有足够的股票
-        filled = min(cum_v[i], shares_to_bid)
-
-        # 最后一周期，只需要成交剩余的部分
-        vol = v[: i + 1].copy()
-        vol[-1] = filled - np.sum(vol[:-1])
-
-        money = sum(c[: i + 1] * vol)
-        mean_price = money / filled
+        mean_price, filled, i = match_bid(
+            np.ascontiguousarray(bid_queue["price"]),
+            np.ascontiguousarray(bid_queue["volume"]),
+            shares_to_bid,
+        )
 
         return mean_price, filled, bid_queue["frame"][i]
 
     def _forward_unclosed_trades(self, dt: datetime.date):
         if len(self._unclosed_trades) != 0 and self._unclosed_trades.get(dt) is None:
-            days = sorted(list(self._unclosed_trades.keys()))
-            frames = tf.get_frames(days[-1], dt, FrameType.DAY)
+            last = next(reversed(self._unclosed_trades))
+            frames = tf.get_frames(last, dt, FrameType.DAY)
             for src, dst in zip(frames[:-1], frames[1:]):
                 src = tf.int2date(src)
                 dst = tf.int2date(dst)
                 self._unclosed_trades[dst] = self._unclosed_trades[src].copy()
+                self._unclosed_by_sec[dst] = {
+                    sec: tids.copy()
+                    for sec, tids in self._unclosed_by_sec.get(src, {}).items()
+                }
 
     def _update_unclosed_trades(self, tid, date: datetime.date):
         """记录每日持有的未平仓交易
@@ -731,20 +820,20 @@ class Broker:
         Args:
             trades: 交易列表
         """
+        security = self.trades[tid].security
+
         unclosed = self._unclosed_trades.get(date, [])
         if len(unclosed):
             unclosed.append(tid)
-
-            return
-
-        if len(self._unclosed_trades) == 0:
+        elif len(self._unclosed_trades) == 0:
             self._unclosed_trades[date] = [tid]
-            return
-
-        # 记录还未创建，需要复制前一日记录
-        self._forward_unclosed_trades(date)
+        else:
+            # 记录还未创建，需要复制前一日记录
+            self._forward_unclosed_trades(date)
+            self._unclosed_trades[date].append(tid)
 
-        self._unclosed_trades[date].append(tid)
+        by_sec = self._unclosed_by_sec.setdefault(date, {})
+        by_sec.setdefault(security, []).append(tid)
 
     async def _after_buy(
         self, en: Entrust, price: float, filled: float, close_time: datetime.datetime
@@ -779,13 +868,21 @@ class Broker:
             date=close_time,
         )
         tradelog.info(
-            f"{en.bid_time.date()}\t{en.side}\t{en.security}\t{filled}\t{price}\t{fee}"
+            "%s\t%s\t%s\t%s\t%s\t%s",
+            en.bid_time.date(),
+            en.side,
+            en.security,
+            filled,
+            price,
+            fee,
         )
 
         logger.info(
             "买入后持仓: \n%s",
-            tabulate_numpy_array(
-                self.get_position(close_time.date(), daily_position_dtype)
+            LazyFormat(
+                lambda: tabulate_numpy_array(
+                    self.get_position(close_time.date(), daily_position_dtype)
+                )
             ),
             date=close_time,
         )
@@ -795,17 +892,16 @@ class Broker:
         self._update_cash(cash_change, close_time.date())
         await self._forward_assets(close_time.date())
 
-        await emit.emit(E_BACKTEST, {"buy": jsonify(trade)})
+        await self._emit_event({"buy": jsonify(trade)})
         return trade
 
     def _update_cash(self, cash_change: float, date: datetime.date):
         """在买入、卖出之后，更新现金流表"""
-        ipos = np.argwhere(self._cash["date"] == date).flatten()
-        if len(ipos) != 1:
+        # _before_trade已将现金表补齐到委托日，因此当日记录总是最后一条
+        if self._cash[-1]["date"] != date:
             raise IndexError("date not found in cash table. before_trade not called?")
 
-        i = ipos.item()
-        self._cash[i]["cash"] += cash_change
+        self._cash[-1]["cash"] += cash_change
 
     async def _before_trade(self, bid_time: datetime.datetime):
         """交易前的准备工作
@@ -819,11 +915,56 @@ class Broker:
             无
         """
         logger.info("before trade", date=bid_time)
+        if self.last_trade_date is not None and bid_time.date() > self.last_trade_date:
+            await self.flush_events()
+            self._price_limits.clear()
+
         await self._calendar_validation(bid_time)
 
         self._forward_cashtable(bid_time.date())
         await self._forward_positions(bid_time.date())
 
+    async def _get_trade_price_limits(
+        self, security: str, date: datetime.date
+    ) -> Tuple:
+        """查询`security`在`date`日的涨跌停价，结果在当日内缓存"""
+        key = (security, date)
+        limits = self._price_limits.get(key)
+        if limits is None:
+            feed = get_app_context().feed
+            limits = await feed.get_trade_price_limits(security, date)
+            self._price_limits[key] = limits
+
+        return limits
+
+    async def _emit_event(self, event: dict):
+        """发送成交事件。如果配置为批量发送，则先缓存，待flush_events时再发送"""
+        if self._batch_events:
+            self._events.append(event)
+        else:
+            await emit.emit(E_BACKTEST, event)
+
+    async def flush_events(self):
+        """将缓存的成交事件一次性发送出去
+
+        事件格式为`{"batch": [{"buy": trade}, {"sell": [trade, ...]}, ...]}`，其中的元素按成交先后排列。本方法在进入新的交易日、查询账户信息、保存回测及停止回测时调用。
+
+        如果发送失败，事件将保留在缓存中，在下一次调用时重新发送。
+        """
+        if len(self._events) == 0:
+            return
+
+        # 先取出再发送，以免发送期间新缓存的事件被清除
+        events, self._events = self._events, []
+        try:
+            await emit.emit(E_BACKTEST, {"batch": events})
+        except Exception as e:
+            logger.exception(e)
+            logger.warning(
+                "failed to emit %s backtest events, retry later", len(events)
+            )
+            self._events = events + self._events
+
     def _forward_cashtable(self, end: datetime.date):
         """补齐现金表到end日"""
         # 现金表已是最新
@@ -835,10 +976,12 @@ class Broker:
 
         start = self._cash[-1]["date"]
         frames = tf.get_frames(start, end, FrameType.DAY)[1:]
-        _, cash = self._cash[-1]
 
-        recs = [(tf.int2date(date), cash) for date in frames]
-        self._cash = np.concatenate((self._cash, np.array(recs, dtype=cash_dtype)))
+        # 按列填充，避免逐行构造tuple再转换为structured array
+        recs = np.empty(len(frames), dtype=cash_dtype)
+        recs["date"] = [tf.int2date(date) for date in frames]
+        recs["cash"] = self._cash[-1]["cash"]
+        self._cash = np.concatenate((self._cash, recs))
 
     async def _forward_positions(self, end: datetime.date):
         """补齐持仓表到`end`日
@@ -869,24 +1012,23 @@ class Broker:
             "handling positions forward from %s to %s", frames[1], end, date=end
         )
 
-        cur_position = self._positions[
-            self._positions["date"] == self._positions[-1]["date"]
-        ]
+        cur_position = self._positions[self._positions_range(start, start)]
 
         # 已清空股票不需要展仓, issue 9
         last_held_position = cur_position[cur_position["shares"] != 0]
 
         if last_held_position.size == 0:
-            empty = np.array(
-                [(frame, None, 0, 0, 0) for frame in frames[1:]],
-                dtype=daily_position_dtype,
-            )
+            empty = np.zeros(len(frames) - 1, dtype=daily_position_dtype)
+            empty["date"] = frames[1:]
+            empty["security"] = None
             self._positions = np.concatenate((self._positions, empty))
             return
 
         secs = last_held_position["security"].tolist()
         dr_info = await feed.get_dr_factor(secs, frames)
 
+        blocks = []
+        xdxr_trades = []
         for sec in secs:
             paddings = pd.DataFrame([], index=frames)
             paddings["security"] = sec
@@ -902,7 +1044,7 @@ class Broker:
             for frame, adjust_share in adjust_shares[adjust_shares > 0].items():
                 order_time = tf.combine_time(frame, 15)
                 trade = Trade(
-                    uuid.uuid4().hex,
+                    next_eid(),
                     sec,
                     paddings.loc[frame, "price"].item(),
                     adjust_share,
@@ -910,17 +1052,24 @@ class Broker:
                     EntrustSide.XDXR,
                     order_time,
                 )
-                self.trades[trade.tid] = trade
-                self._update_unclosed_trades(trade.tid, order_time.date())
-            self._positions = np.concatenate(
-                (
-                    self._positions,
-                    paddings.iloc[1:]
-                    .to_records(index=True)
-                    .astype(self._positions.dtype),
-                )
+                xdxr_trades.append(trade)
+
+            blocks.append(
+                paddings.iloc[1:].to_records(index=True).astype(self._positions.dtype)
             )
 
+        # 各证券的补齐记录须按日期重新排列（稳定排序，同一天内保持证券的顺序），
+        # 以保证持仓表始终按日期递增，同一天的记录是连续的一段
+        forwarded = np.concatenate(blocks)
+        forwarded = forwarded[np.argsort(forwarded["date"], kind="stable")]
+        self._positions = np.concatenate((self._positions, forwarded))
+
+        # 未平仓交易表同样要求按日期依次追加，因此除权交易也按日期顺序记录
+        xdxr_trades.sort(key=lambda trade: trade.time)
+        for trade in xdxr_trades:
+            self.trades[trade.tid] = trade
+            self._update_unclosed_trades(trade.tid, trade.time.date())
+
     async def _update_positions(self, trade: Trade, bid_date: datetime.date):
         """更新持仓信息
 
@@ -938,10 +1087,8 @@ class Broker:
             self._positions = self._positions[:-1]
 
         # find if the security is already in the position (same day)
-        pos = np.argwhere(
-            (self._positions["security"] == trade.security)
-            & (self._positions["date"] == bid_date)
-        )
+        day = self._positions_range(bid_date, bid_date)
+        pos = np.flatnonzero(self._positions["security"][day] == trade.security)
 
         if pos.size == 0:
             self._positions = np.append(
@@ -952,7 +1099,7 @@ class Broker:
                 ),
             )
         else:
-            i = pos[0].item()
+            i = day.start + pos[0].item()
             *_, old_shares, old_sellable, old_price = self._positions[i]
             new_shares, new_price = trade.shares, trade.price
 
@@ -1003,66 +1150,98 @@ class Broker:
         security = en.security
 
         unclosed_trades = self.get_unclosed_trades(dt)
-        closed_trades = []
+        candidates = self._unclosed_by_sec.get(dt, {}).get(security, [])
+        closed_trades = set()
         exit_trades = []
         refund = 0
-        while to_sell > 0:
-            for tid in unclosed_trades:
-                trade: Trade = self.trades[tid]
-                if trade.security != security:
-                    continue
-
-                if trade.time.date() >= dt:
-                    # not T + 1
-                    continue
-
-                to_sell, fee, exit_trade, tx = trade.sell(
-                    to_sell, price, fee, en.bid_time
-                )
-
-                logger.info(
-                    "卖出成交: %s (%d %.2f %.2f),委单号: %s, 成交号: %s",
-                    en.security,
-                    exit_trade.shares,
-                    exit_trade.price,
-                    exit_trade.fee,
-                    en.eid,
-                    exit_trade.tid,
-                    date=exit_trade.time,
-                )
-                tradelog.info(
-                    f"{en.bid_time.date()}\t{exit_trade.side}\t{exit_trade.security}\t{exit_trade.shares}\t{exit_trade.price}\t{exit_trade.fee}"
-                )
-                await self._update_positions(exit_trade, exit_trade.time.date())
-                exit_trades.append(exit_trade)
-                self.trades[exit_trade.tid] = exit_trade
-                self.transactions.append(tx)
+        day_start = datetime.datetime.combine(dt, datetime.time())
+        trades = self.trades
+        for tid in candidates:
+            if to_sell <= 0:
+                break
 
-                refund += exit_trade.shares * exit_trade.price - exit_trade.fee
+            trade: Trade = trades[tid]
+            if trade.time >= day_start:
+                # not T + 1
+                continue
+
+            to_sell, fee, exit_trade, tx = trade.sell(to_sell, price, fee, en.bid_time)
+
+            logger.info(
+                "卖出成交: %s (%d %.2f %.2f),委单号: %s, 成交号: %s",
+                en.security,
+                exit_trade.shares,
+                exit_trade.price,
+                exit_trade.fee,
+                en.eid,
+                exit_trade.tid,
+                date=exit_trade.time,
+            )
+            tradelog.info(
+                "%s\t%s\t%s\t%s\t%s\t%s",
+                en.bid_time.date(),
+                exit_trade.side,
+                exit_trade.security,
+                exit_trade.shares,
+                exit_trade.price,
+                exit_trade.fee,
+            )
+            await self._update_positions(exit_trade, exit_trade.time.date())
+            exit_trades.append(exit_trade)
+            trades[exit_trade.tid] = exit_trade
+            self._append_transaction(tx)
 
-                if trade.closed:
-                    closed_trades.append(tid)
+            refund += exit_trade.shares * exit_trade.price - exit_trade.fee
 
-                if to_sell == 0:
-                    break
-            else:  # no more unclosed trades, even if to_sell > 0
-                break
+            if trade.closed:
+                closed_trades.add(tid)
 
-        unclosed_trades = [tid for tid in unclosed_trades if tid not in closed_trades]
-        self._unclosed_trades[dt] = unclosed_trades
+        if closed_trades:
+            self._unclosed_trades[dt] = [
+                tid for tid in unclosed_trades if tid not in closed_trades
+            ]
+            self._unclosed_by_sec[dt][security] = [
+                tid for tid in candidates if tid not in closed_trades
+            ]
 
         logger.info(
             "卖出后持仓: \n%s",
-            tabulate_numpy_array(self.get_position(dt, daily_position_dtype)),
+            LazyFormat(
+                lambda: tabulate_numpy_array(
+                    self.get_position(dt, daily_position_dtype)
+                )
+            ),
             date=dt,
         )
 
         self._update_cash(refund, en.bid_time.date())
         await self._forward_assets(en.bid_time.date())
 
-        await emit.emit(E_BACKTEST, {"sell": jsonify(exit_trades)})
+        await self._emit_event({"sell": jsonify(exit_trades)})
         return exit_trades
 
+    def _append_transaction(self, tx: Transaction):
+        """记录一笔配对交易，同时更新其日期和盈亏列"""
+        self.transactions.append(tx)
+        self._tx_entry_days.append(np.datetime64(tx.entry_time, "D"))
+        self._tx_exit_days.append(np.datetime64(tx.exit_time, "D"))
+        self._tx_profits.append(tx.profit)
+
+    def _tx_columns(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """以ndarray形式返回所有配对交易的买入日、卖出日和盈亏
+
+        配对交易只会追加，因此当记录数不变时，直接返回上一次转换的结果。
+        """
+        n = len(self._tx_profits)
+        if self._tx_arrays is None or self._tx_arrays[2].size != n:
+            self._tx_arrays = (
+                np.array(self._tx_entry_days, dtype="datetime64[D]"),
+                np.array(self._tx_exit_days, dtype="datetime64[D]"),
+                np.array(self._tx_profits, dtype=np.float64),
+            )
+
+        return self._tx_arrays
+
     async def sell(
         self,
         security: str,
@@ -1098,10 +1277,15 @@ class Broker:
         feed = get_app_context().feed
 
         entrustlog.info(
-            f"{bid_time}\t{security}\t{bid_shares}\t{bid_price}\t{EntrustSide.SELL}"
+            "%s\t%s\t%s\t%s\t%s",
+            bid_time,
+            security,
+            bid_shares,
+            bid_price,
+            EntrustSide.SELL,
         )
         logger.info("卖出委托: %s %s %s", security, bid_price, bid_shares, date=bid_time)
-        _, buy_limit_price, sell_limit_price = await feed.get_trade_price_limits(
+        _, buy_limit_price, sell_limit_price = await self._get_trade_price_limits(
             security, bid_time.date()
         )
 
@@ -1161,10 +1345,20 @@ class Broker:
         Returns:
             可卖股数
         """
+        bid_date = bid_time.date()
+
+        # get_unclosed_trades会将未平仓记录补齐到bid_date，之后只需遍历该证券的记录
+        self.get_unclosed_trades(bid_date)
+        candidates = self._unclosed_by_sec.get(bid_date, {}).get(security, [])
+
+        # 早于当日零点成交的才满足T+1，直接比较时间以免每次都构造date对象
+        day_start = datetime.datetime.combine(bid_date, datetime.time())
+        trades = self.trades
+
         shares = 0
-        for tid in self.get_unclosed_trades(bid_time.date()):
-            t = self.trades[tid]
-            if t.security == security and t.time.date() < bid_time.date():
+        for tid in candidates:
+            t = trades[tid]
+            if t.time < day_start:
                 if t.side in (EntrustSide.BUY, EntrustSide.XDXR):
                     assert t.closed is False
                 shares += t._unsell
@@ -1185,17 +1379,20 @@ class Broker:
         """
         去掉已达到涨停时的分钟线，或者价格高于买入价的bars，并且，如果当天有跌停价，将该处的成交量修改为无穷大，以便后面做撮合时，可以无限量买入
         """
-        reach_limit = array_price_equal(bars["price"], buy_limit_price)
-        bars = bars[(~reach_limit)]
-
-        if bars.size == 0:
+        idx, where_sell_stop, all_limit = filter_bars(
+            np.ascontiguousarray(bars["price"]),
+            price,
+            price_to_ticks(buy_limit_price).item(),
+            price_to_ticks(sell_limit_price).item(),
+            True,
+        )
+        if all_limit:
             raise BuylimitError(security, order_time, with_stack=True)
 
-        bars = bars[(bars["price"] <= price)]
-        if bars.size == 0:
+        if idx.size == 0:
             raise PriceNotMeet(security, price, order_time, with_stack=True)
 
-        where_sell_stop = array_price_equal(bars["price"], sell_limit_price)
+        bars = bars[idx]
         bars["volume"][where_sell_stop] = 1e20
         return bars
 
@@ -1213,17 +1410,20 @@ class Broker:
         如果存在涨停的bar，这些bar上的成交量将放大到1e20，以便后面模拟允许涨停板上无限卖出的行为。
 
         """
-        reach_limit = array_price_equal(bars["price"], sell_limit_price)
-        bars = bars[(~reach_limit)]
-
-        if bars.size == 0:
+        idx, where_buy_stop, all_limit = filter_bars(
+            np.ascontiguousarray(bars["price"]),
+            price,
+            price_to_ticks(sell_limit_price).item(),
+            price_to_ticks(buy_limit_price).item(),
+            False,
+        )
+        if all_limit:
             raise SellLimitError(security, order_time, with_stack=True)
 
-        bars = bars[(bars["price"] >= price)]
-        if bars.size == 0:
+        if idx.size == 0:
             raise PriceNotMeet(security, price, order_time, with_stack=True)
 
-        where_buy_stop = array_price_equal(bars["price"], buy_limit_price)
+        bars = bars[idx]
         bars["volume"][where_buy_stop] = 1e20
         return bars
 
@@ -1270,96 +1470,59 @@ class Broker:
         if not self._bt_stopped:
             raise TradeError("call stop_backtest before invoke this")
 
-        try:
-            rf = cfg.metrics.risk_free_rate / cfg.metrics.annual_days
-        except Exception:
-            rf = 0
+        rf, annual_days = self._rf, self._annual_days
 
         start = max(start or self.bt_start, self.first_trade_date or self.bt_start)
         end = min(self.last_trade_date or self.bt_end, end or self.bt_end)
 
-        tx = []
-        logger.info("%s tx in total", len(self.transactions))
-        for t in self.transactions:
-            if t.entry_time.date() >= start and t.exit_time.date() <= end:
-                tx.append(t)
-            else:
-                logger.info(
-                    "tx %s not in range, start: %s, end: %s",
-                    t.sec,
-                    t.entry_time,
-                    t.exit_time,
-                )
+        entry_days, exit_days, profits = self._tx_columns()
+        in_range = (entry_days >= np.datetime64(start, "D")) & (
+            exit_days <= np.datetime64(end, "D")
+        )
+        idx = np.flatnonzero(in_range)
 
         # 资产暴露时间
-        window = tf.count_day_frames(start, end)
-        total_tx = len(tx)
+        window = count_day_frames(start, end)
+        total_tx = idx.size
+        logger.info(
+            "%s tx in total, %s in range [%s, %s]",
+            len(self.transactions),
+            total_tx,
+            start,
+            end,
+        )
 
         if total_tx == 0:
-            return {
-                "start": start,
-                "end": end,
-                "window": window,
-                "total_tx": total_tx,
-                "total_profit": None,
-                "total_profit_rate": None,
-                "win_rate": None,
-                "mean_return": None,
-                "sharpe": None,
-                "sortino": None,
-                "calmar": None,
-                "max_drawdown": None,
-                "annual_return": None,
-                "volatility": None,
-                "baseline": None,
-            }
-
-        # win_rate
-        wr = len([t for t in tx if t.profit > 0]) / total_tx
-
-        total_profit = self._assets[-1]["assets"] - self._assets[0]["assets"]
-
-        returns = self.get_returns(start, end)
-        mean_return = np.mean(returns)
-
-        sharpe = sharpe_ratio(returns, rf)
-        sortino = sortino_ratio(returns, rf)
-        calma = calmar_ratio(returns)
-        mdd = max_drawdown(returns)
-
-        # 年化收益率
-        ar = annual_return(returns)
-
-        # 年化波动率
-        vr = annual_volatility(returns)
+            result = _EMPTY_METRICS.copy()
+            result.update(start=start, end=end, window=window, total_tx=total_tx)
+            return result
 
-        # 计算参考标的的相关指标
+        # 基准行情的查询与本地计算无关，先发出查询，使其网络往返与下面的计算重叠
+        ref_task = None
         if baseline is not None:
-            ref_bars = await Stock.get_bars_in_range(
-                baseline, FrameType.DAY, self.bt_start, self.bt_end
+            ref_task = asyncio.create_task(
+                self._baseline_metrics(baseline, rf, annual_days)
             )
+            await asyncio.sleep(0)
 
-            if ref_bars.size < 2:
-                ref_results = None
-            else:
-                returns = ref_bars["close"][1:] / ref_bars["close"][:-1] - 1
-
-                ref_results = {
-                    "start": self.bt_start,
-                    "end": self.bt_end,
-                    "window": tf.count_day_frames(self.bt_start, self.bt_end),
-                    "total_profit_rate": cum_returns_final(returns),
-                    "win_rate": np.count_nonzero(returns > 0) / len(returns),
-                    "mean_return": np.mean(returns).item(),
-                    "sharpe": sharpe_ratio(returns, rf),
-                    "sortino": sortino_ratio(returns, rf),
-                    "calmar": calmar_ratio(returns),
-                    "max_drawdown": max_drawdown(returns),
-                    "annual_return": annual_return(returns),
-                    "volatility": annual_volatility(returns),
-                }
-        else:
-            ref_results = None
+        try:
+            # win_rate
+            wr = np.count_nonzero(profits[idx] > 0) / total_tx
+
+            total_profit = self._assets[-1]["assets"] - self._assets[0]["assets"]
+
+            returns = self.get_returns(start, end)
+
+            # ar: 年化收益率, vr: 年化波动率
+            stats = returns_metrics(returns, rf, annual_days)
+            mean_return, _, _, sharpe, sortino, calma, mdd, ar, vr = stats
+        except Exception:
+            if ref_task is not None:
+                ref_task.cancel()
+            raise
+
+        # 计算参考标的的相关指标
+        ref_results = None if ref_task is None else await ref_task
 
         return {
             "start": start,
@@ -1379,9 +1542,64 @@ class Broker:
             "baseline": ref_results,
         }
 
+    async def _baseline_metrics(
+        self, baseline: str, rf: float, annual_days: int
+    ) -> Optional[Dict]:
+        """计算参考标的在回测期间的指标
+
+        Args:
+            baseline: 参考标的
+            rf: 无风险日利率
+            annual_days: 每年的交易日数
+
+        Returns:
+            指标字典，参见[metrics][backtest.trade.broker.Broker.metrics]。如果参考标的行情不足两天，返回None
+        """
+        ref_bars = await Stock.get_bars_in_range(
+            baseline, FrameType.DAY, self.bt_start, self.bt_end
+        )
+
+        if ref_bars.size < 2:
+            return None
+
+        # 行情本身是float32，回报也以float32计算，减少一半的内存带宽
+        # ref_bars["close"]是structured array中跨步的视图，先物化为连续数组
+        close = np.ascontiguousarray(ref_bars["close"], dtype=np.float32)
+        returns = np.empty(close.size - 1, dtype=np.float32)
+        np.divide(close[1:], close[:-1], out=returns)
+        returns -= np.float32(1.0)
+
+        (
+            mean_return,
+            cum_return,
+            win_rate,
+            sharpe,
+            sortino,
+            calmar,
+            mdd,
+            ar,
+            vr,
+        ) = returns_metrics(returns, rf, annual_days)
+
+        return {
+            "start": self.bt_start,
+            "end": self.bt_end,
+            "window": count_day_frames(self.bt_start, self.bt_end),
+            "total_profit_rate": cum_return,
+            "win_rate": win_rate,
+            "mean_return": mean_return,
+            "sharpe": sharpe,
+            "sortino": sortino,
+            "calmar": calmar,
+            "max_drawdown": mdd,
+            "annual_return": ar,
+            "volatility": vr,
+        }
+
     async def stop_backtest(self):
         """停止回测，冻结指标"""
         self._bt_stopped = True
+        await self.flush_events()
         self._forward_cashtable(self.bt_end)
         await self._forward_positions(self.bt_end)
         await self._forward_assets(self.bt_end)
@@ -1,11 +1,46 @@
 import datetime
-import uuid
+import itertools
 from enum import IntEnum
 from typing import Final, Union
 
 import numpy as np
 
 E_BACKTEST: Final = "BACKTEST"
+"""成交事件。
+
+默认每次成交后立即发出，买入时事件数据为`{"buy": trade}`，卖出时为`{"sell": [trade, ...]}`。
+
+如果配置项`events.batch`为真，同一交易日内的成交事件先缓存在broker中，在进入下一个交易日（该日的首次委托）、查询账户信息、保存回测或者停止回测时，一次性发出。此时事件数据的格式为：
+
+    ```
+    {
+        "batch": [
+            {"buy": trade},
+            {"sell": [trade, ...]},
+            ...
+        ]
+    }
+    ```
+
+其中`batch`中的元素按成交先后排列，每个元素与逐笔发出时的事件数据相同。
+"""
+
+# 委托号和成交号只需在进程内唯一，因此使用递增序号，而不必每次都生成uuid
+_eid_seq = itertools.count(1)
+_tid_seq = itertools.count(1)
+
+
+def next_eid() -> str:
+    """生成新的委托号
+
+    除了委托以外，除权除息产生的交易也使用本方法生成委托号，以使所有委托号的格式一致。
+    """
+    return f"e{next(_eid_seq)}"
+
+
+def next_tid() -> str:
+    """生成新的成交号"""
+    return f"t{next(_tid_seq)}"
 
 
 class EntrustSide(IntEnum):
@@ -14,11 +49,7 @@ class EntrustSide(IntEnum):
     XDXR = 0
 
     def __str__(self):
-        return {
-            EntrustSide.BUY: "买入",
-            EntrustSide.SELL: "卖出",
-            EntrustSide.XDXR: "分红配股",
-        }[self]
+        return _entrust_side_names[self]
 
 
 class BidType(IntEnum):
@@ -26,10 +57,30 @@ class BidType(IntEnum):
     MARKET = 2
 
     def __str__(self):
-        return {BidType.LIMIT: "限价委托", BidType.MARKET: "市价委托"}.get(self)
+        return _bid_type_names.get(self)
+
+
+# 枚举成员的中文名称。在模块级别一次性构造，而不必每次调用__str__时都创建字典
+_entrust_side_names = {
+    EntrustSide.BUY: "买入",
+    EntrustSide.SELL: "卖出",
+    EntrustSide.XDXR: "分红配股",
+}
+
+_bid_type_names = {BidType.LIMIT: "限价委托", BidType.MARKET: "市价委托"}
 
 
 class Entrust:
+    __slots__ = (
+        "eid",
+        "security",
+        "side",
+        "bid_type",
+        "bid_shares",
+        "bid_price",
+        "bid_time",
+    )
+
     def __init__(
         self,
         security: str,
@@ -39,7 +90,7 @@ class Entrust:
         bid_time: datetime.datetime,
         bid_type: BidType = BidType.MARKET,
     ):
-        self.eid = str(uuid.uuid4())  # the contract id
+        self.eid = next_eid()  # the contract id
         self.security = security
         self.side = side
         self.bid_type = bid_type
@@ -0,0 +1,93 @@
+"""撮合前对分钟线的过滤
+
+[Broker][backtest.trade.broker.Broker]在每次委托时都要从当日的分钟线中去掉无法成交的bar。这里将涨跌停判断、价格比较和对手方涨跌停标记合并为一次遍历，避免生成多个中间的mask和数组。
+
+价格均换算成以分为单位的整数后再比较，与[price_to_ticks][backtest.common.helper.price_to_ticks]的口径一致。
+"""
+import numpy as np
+from numba import njit
+
+
+@njit(
+    "Tuple((int64[:], boolean[:], boolean))(float32[:], float32, int64, int64, boolean)",
+    cache=True,
+)
+def filter_bars(
+    prices: np.ndarray,
+    price: float,
+    limit_ticks: int,
+    opposite_ticks: int,
+    is_buy: bool,
+):
+    """找出可以成交的bar
+
+    买入时，去掉已涨停（`limit_ticks`）和价格高于委托价的bar；卖出时，去掉已跌停和价格低于委托价的bar。
+
+    Args:
+        prices: 撮合数据中的价格列
+        price: 委托价
+        limit_ticks: 本方向的涨跌停价（以分计）。买入时为涨停价，卖出时为跌停价
+        opposite_ticks: 对手方向的涨跌停价（以分计）
+        is_buy: 是否为买入
+
+    Returns:
+        (可成交的bar的索引, 这些bar是否处于对手方涨跌停, 是否全部bar都已达到本方向涨跌停)
+    """
+    n = prices.size
+    keep = np.empty(n, dtype=np.int64)
+    at_opposite = np.empty(n, dtype=np.bool_)
+
+    k = 0
+    reach_limit = 0
+    for i in range(n):
+        p = prices[i]
+        ticks = round(np.float64(p) * 100.0)
+        if ticks == limit_ticks:
+            reach_limit += 1
+            continue
+
+        if (is_buy and p > price) or (not is_buy and p < price):
+            continue
+
+        keep[k] = i
+        at_opposite[k] = ticks == opposite_ticks
+        k += 1
+
+    return keep[:k], at_opposite[:k], reach_limit == n
+
+
+@njit(
+    "Tuple((float64, float64, int64))(float32[:], float64[:], float64)",
+    cache=True,
+    error_model="numpy",
+)
+def match_bid(prices: np.ndarray, volumes: np.ndarray, shares: float):
+    """按时间顺序逐个bar撮合，直到成交`shares`股或者用完所有的bar
+
+    最后一个参与撮合的bar只成交剩余的部分。
+
+    Args:
+        prices: 撮合数据中的价格列
+        volumes: 撮合数据中的成交量列
+        shares: 委托股数
+
+    Returns:
+        (成交均价, 成交股数, 最后一个参与撮合的bar的索引)
+
+    Raises:
+        ValueError: 没有可以撮合的bar
+    """
+    n = volumes.size
+    if n == 0:
+        raise ValueError("no bars to match")
+
+    filled = 0.0
+    money = 0.0
+    for i in range(n):
+        take = min(volumes[i], shares - filled)
+        money += np.float64(prices[i]) * take
+        filled += take
+        if filled >= shares:
+            return money / filled, filled, i
+
+    return money / filled, filled, n - 1
@@ -0,0 +1,112 @@
+"""回测指标计算
+
+对每日回报率序列只遍历一次，即可得到[Broker.metrics][backtest.trade.broker.Broker.metrics]所需的各项风险收益指标。各指标的定义与[empyrical](https://github.com/quantopian/empyrical)一致：
+
+- sharpe, sortino, volatility均以`annual_days`进行年化
+- max_drawdown以累积净值计算
+- calmar为年化收益率与最大回撤绝对值之比，当最大回撤为零时为nan
+- 忽略回报率序列中的nan
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+
+@njit(
+    [
+        "UniTuple(float64, 9)(float32[:], float64, int64)",
+        "UniTuple(float64, 9)(float64[:], float64, int64)",
+    ],
+    cache=True,
+    error_model="numpy",
+)
+def returns_metrics(returns: np.ndarray, rf: float, annual_days: int):
+    """计算每日回报率序列的各项指标
+
+    Args:
+        returns: 每日回报率，可以是float32或者float64数组。内部累加均以float64进行
+        rf: 无风险日利率
+        annual_days: 每年的交易日数，用以年化
+
+    Returns:
+        (mean_return, cum_return, win_rate, sharpe, sortino, calmar, max_drawdown, annual_return, volatility)
+    """
+    nan = np.nan
+    n = returns.size
+    if n == 0:
+        return nan, nan, nan, nan, nan, nan, nan, nan, nan
+
+    # Welford算法求均值和方差，累乘求净值和最大回撤，同时累计下行偏差
+    count = 0
+    wins = 0
+    mean = 0.0
+    m2 = 0.0
+    downside = 0.0
+    total = 0.0
+    wealth = 1.0
+    peak = 1.0
+    mdd = 0.0
+    for i in range(n):
+        r = returns[i]
+        total += r
+        if math.isnan(r):
+            continue
+
+        count += 1
+        if r > 0:
+            wins += 1
+
+        delta = r - mean
+        mean += delta / count
+        m2 += delta * (r - mean)
+
+        excess = r - rf
+        if excess < 0:
+            downside += excess * excess
+
+        wealth *= 1.0 + r
+        if wealth > peak:
+            peak = wealth
+        dd = (wealth - peak) / peak
+        if dd < mdd:
+            mdd = dd
+
+    mean_return = total / n
+    cum_return = wealth - 1.0
+    win_rate = wins / n
+    annual_return = wealth ** (annual_days / n) - 1.0
+
+    if count < 2:
+        std = nan
+    else:
+        std = math.sqrt(m2 / (count - 1))
+
+    volatility = std * math.sqrt(annual_days)
+
+    if n < 2:
+        sharpe = nan
+        sortino = nan
+    else:
+        excess_mean = mean - rf
+        sharpe = excess_mean / std * math.sqrt(annual_days)
+        downside_risk = math.sqrt(downside / count) * math.sqrt(annual_days)
+        sortino = excess_mean * annual_days / downside_risk
+
+    calmar = nan
+    if mdd < 0:
+        calmar = annual_return / abs(mdd)
+        if math.isinf(calmar):
+            calmar = nan
+
+    return (
+        mean_return,
+        cum_return,
+        win_rate,
+        sharpe,
+        sortino,
+        calmar,
+        mdd,
+        annual_return,
+        volatility,
+    )
@@ -1,18 +1,33 @@
 import datetime
-import uuid
 from typing import Union
 
 from omicron.core.backtestlog import BacktestLogger
 
-from backtest.trade.datatypes import EntrustSide
+from backtest.common.helper import SlotsStateMixin
+from backtest.trade.datatypes import EntrustSide, next_tid
 from backtest.trade.transaction import Transaction
 
 logger = BacktestLogger.getLogger(__name__)
 
 
-class Trade:
+class Trade(SlotsStateMixin):
     """Trade对象代表了一笔已成功完成的委托。一个委托可能对应多个Trade，特别是当卖出的时候"""
 
+    # 回测中会产生大量Trade对象，使用__slots__以节省内存
+    __slots__ = (
+        "eid",
+        "tid",
+        "security",
+        "fee",
+        "price",
+        "shares",
+        "time",
+        "side",
+        "_unsell",
+        "_unamortized_fee",
+        "closed",
+    )
+
     def __init__(
         self,
         eid: str,
@@ -34,7 +49,7 @@ class Trade:
             time: 交易时间
         """
         self.eid = eid
-        self.tid = str(uuid.uuid4())
+        self.tid = next_tid()
         self.security = security
 
         self.fee = fee
@@ -1,11 +1,24 @@
 import datetime
 
-from omicron.models.timeframe import TimeFrame as tf
+from backtest.common.helper import SlotsStateMixin, count_day_frames
 
 
-class Transaction:
+class Transaction(SlotsStateMixin):
     """包括了买和卖的一次完整交易"""
 
+    __slots__ = (
+        "sec",
+        "entry_time",
+        "exit_time",
+        "entry_price",
+        "exit_price",
+        "shares",
+        "fee",
+        "profit",
+        "pprofit",
+        "window",
+    )
+
     def __init__(
         self,
         sec: str,
@@ -28,9 +41,18 @@ class Transaction:
         self.pprofit = self.profit / (entry_price * shares)
 
         try:  # 如果omicron未初始化，则不计算资产暴露窗口
-            self.window = tf.count_day_frames(entry_time, exit_time)
+            self.window = count_day_frames(entry_time.date(), exit_time.date())
         except Exception:
             pass
 
     def __str__(self):
         return f"{self.sec} {self.entry_time}买入({self.entry_price}, {self.exit_time}卖出({self.exit_price}), profit {self.exit_price/self.entry_price - 1:.2%}"
+
+    def to_dict(self) -> dict:
+        """将Transaction对象转换为字典格式
+
+        如果创建时未能计算资产暴露窗口，则结果中不包含`window`
+        """
+        return {
+            name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)
+        }
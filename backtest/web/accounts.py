@@ -26,6 +26,8 @@ backtest_index_file = os.path.join(home_dir(), "backtest.index.json")
 
 class Accounts:
     _brokers: Dict[str, Broker] = {}
+    # account_name -> token，用以按账户名查找，而不必遍历所有的broker
+    _tokens: Dict[str, str] = {}
     _state_index = {}
 
     def on_startup(self):
@@ -33,6 +35,7 @@ class Accounts:
         self._brokers[token] = Broker(
             "admin", 0, 0.0, admin_start_end_dt, admin_start_end_dt
         )
+        self._tokens["admin"] = token
 
         try:
             with open(backtest_index_file, "r") as f:
@@ -43,9 +46,19 @@ class Accounts:
             logger.exception(e)
 
     def on_exit(self):
-        with open(backtest_index_file, "w") as f:
+        self._save_state_index()
+
+    def _save_state_index(self):
+        """将回测索引写入磁盘
+
+        先写入临时文件再原子地替换，避免写入中途退出时索引文件损坏，导致所有已保存的回测都无法加载。
+        """
+        tmp_file = backtest_index_file + ".tmp"
+        with open(tmp_file, "w") as f:
             json.dump(self._state_index, f)
 
+        os.replace(tmp_file, backtest_index_file)
+
     def get_broker(self, token: str) -> Union[None, Broker]:
         return self._brokers.get(token)
 
@@ -53,7 +66,6 @@ class Accounts:
         return token in self._brokers
 
     def is_admin(self, token: str):
-        cfg = cfg4py.get_instance()
         return token == cfg.auth.admin
 
     def create_account(
@@ -81,13 +93,13 @@ class Accounts:
             msg = f"账户{name}:{token}已经存在，不能重复创建。"
             raise AccountConflictError(msg, with_stack=True)
 
-        for broker in self._brokers.values():
-            if broker.account_name == name:
-                msg = f"账户{name}:{token}已经存在，不能重复创建。"
-                raise AccountConflictError(msg, with_stack=True)
+        if name in self._tokens:
+            msg = f"账户{name}:{token}已经存在，不能重复创建。"
+            raise AccountConflictError(msg, with_stack=True)
 
         broker = Broker(name, principal, commission, start, end)
         self._brokers[token] = broker
+        self._tokens[name] = token
 
         logger.info("新建账户:%s, %s", name, token)
         return {
@@ -120,18 +132,18 @@ class Accounts:
             self._brokers[cfg.auth.admin] = Broker(
                 "admin", 0, 0.0, admin_start_end_dt, admin_start_end_dt
             )
+            self._tokens = {"admin": cfg.auth.admin}
             return 0
         else:
-            for token, broker in self._brokers.items():
-                if broker.account_name == account_to_delete:
-                    del self._brokers[token]
-                    logger.info("账户:%s已删除", account_to_delete)
-
-                    return len(self._brokers) - 1
-            else:
+            token = self._tokens.pop(account_to_delete, None)
+            if token is None:
                 logger.warning("账户%s不存在", account_to_delete)
                 return len(self._brokers)
 
+            del self._brokers[token]
+            logger.info("账户:%s已删除", account_to_delete)
+            return len(self._brokers) - 1
+
     async def save_backtest(
         self,
         name_prefix: str,
@@ -161,22 +173,21 @@ class Accounts:
         if not broker._bt_stopped:
             raise TradeError("call `stop_backtest` first!")
 
+        await broker.flush_events()
+
+        # 状态文件只由本服务读取，无须兼容旧版本的Python，因此使用最高版本的协议
+        state = {
+            "name": name,
+            "bills": broker.bills(),
+            "metrics": await broker.metrics(baseline=baseline),
+            "params": strategy_params or {},
+            "desc": desc,
+        }
         with open(state_file, "wb") as f:
-            pickle.dump(
-                {
-                    "name": name,
-                    "bills": broker.bills(),
-                    "metrics": await broker.metrics(baseline=baseline),
-                    "params": strategy_params or {},
-                    "desc": desc,
-                },
-                f,
-            )
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         self._state_index[name] = {"token": token}
-
-        with open(backtest_index_file, "w") as f:
-            json.dump(self._state_index, f)
+        self._save_state_index()
 
         return name
 
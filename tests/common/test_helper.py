@@ -3,7 +3,7 @@ import unittest
 
 import numpy as np
 
-from backtest.common.helper import jsonify, tabulate_numpy_array
+from backtest.common.helper import jsonify, price_to_ticks, tabulate_numpy_array
 
 
 class HelperTest(unittest.TestCase):
@@ -60,3 +60,14 @@ class HelperTest(unittest.TestCase):
 │   4 │   5 │   6 │
 ╘═════╧═════╧═════╛"""
         self.assertEqual(exp, actual)
+
+    def test_price_to_ticks(self):
+        prices = np.array([9.43, 9.68, 10.1, 11.24], dtype="f4")
+        actual = price_to_ticks(prices)
+        self.assertEqual(np.int64, actual.dtype)
+        np.testing.assert_array_equal([943, 968, 1010, 1124], actual)
+
+        self.assertEqual(943, price_to_ticks(9.43))
+        np.testing.assert_array_equal(
+            price_to_ticks(prices), price_to_ticks(prices + 1e-4)
+        )
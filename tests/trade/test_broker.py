@@ -252,6 +252,102 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
         )
         self.assertEqual(999900000, result.shares)
 
+    async def test_metrics_config(self):
+        # 缺失的配置项使用默认值，不影响其它已配置的项
+        metrics = mock.Mock(spec=["annual_days"], annual_days=250)
+        with mock.patch(
+            "backtest.trade.broker.cfg", mock.Mock(spec=["metrics"], metrics=metrics)
+        ):
+            broker = Broker("test", 1e6, 1e-4, mar1, mar14)
+            self.assertEqual(250, broker._annual_days)
+            self.assertEqual(0.0, broker._rf)
+
+        metrics = mock.Mock(spec=["risk_free_rate"], risk_free_rate=0.0252)
+        with mock.patch(
+            "backtest.trade.broker.cfg", mock.Mock(spec=["metrics"], metrics=metrics)
+        ):
+            broker = Broker("test", 1e6, 1e-4, mar1, mar14)
+            self.assertEqual(252, broker._annual_days)
+            self.assertAlmostEqual(1e-4, broker._rf)
+
+        # 非法的配置不会被掩盖
+        metrics = mock.Mock(annual_days="abc", risk_free_rate=0.03)
+        with mock.patch(
+            "backtest.trade.broker.cfg", mock.Mock(spec=["metrics"], metrics=metrics)
+        ):
+            with self.assertRaises(ValueError):
+                Broker("test", 1e6, 1e-4, mar1, mar14)
+
+    async def test_backtest_events(self):
+        # 默认逐笔发送
+        broker = Broker("test", 1e10, 1e-4, mar1, mar14)
+        with mock.patch(
+            "backtest.trade.broker.emit.emit", new_callable=mock.AsyncMock
+        ) as mocked:
+            bid_time = datetime.datetime(2022, 3, 10, 9, 35)
+            trade = await broker.buy(hljh, 9.43, 1e5, bid_time)
+            mocked.assert_called_once()
+            event, data = mocked.call_args.args
+            self.assertEqual(E_BACKTEST, event)
+            self.assertEqual(trade.tid, data["buy"]["tid"])
+
+            mocked.reset_mock()
+            await broker.stop_backtest()
+            mocked.assert_not_called()
+
+        # 按交易日批量发送
+        broker = Broker("test", 1e10, 1e-4, mar1, mar14)
+        broker._batch_events = True
+
+        with mock.patch(
+            "backtest.trade.broker.emit.emit", new_callable=mock.AsyncMock
+        ) as mocked:
+            bid_time = datetime.datetime(2022, 3, 10, 9, 35)
+            trade1 = await broker.buy(hljh, 9.43, 1e5, bid_time)
+            trade2 = await broker.buy(hljh, 9.43, 2e5, bid_time)
+
+            # 同一交易日内的成交事件被缓存，不会立即发出
+            mocked.assert_not_called()
+
+            # 进入下一个交易日时，前一日的事件按成交先后一次性发出
+            trade3 = await broker.buy(
+                tyst, 11.2, 5e4, datetime.datetime(2022, 3, 11, 9, 35)
+            )
+            mocked.assert_called_once()
+            event, data = mocked.call_args.args
+            self.assertEqual(E_BACKTEST, event)
+            self.assertListEqual(
+                [trade1.tid, trade2.tid], [e["buy"]["tid"] for e in data["batch"]]
+            )
+
+            # 停止回测时，发出剩余的事件
+            mocked.reset_mock()
+            await broker.stop_backtest()
+            mocked.assert_called_once()
+            event, data = mocked.call_args.args
+            self.assertEqual(E_BACKTEST, event)
+            self.assertListEqual([trade3.tid], [e["buy"]["tid"] for e in data["batch"]])
+
+        # 发送失败时，事件保留在缓存中，下次发送时一并发出
+        broker = Broker("test", 1e10, 1e-4, mar1, mar14)
+        broker._batch_events = True
+        with mock.patch(
+            "backtest.trade.broker.emit.emit", new_callable=mock.AsyncMock
+        ) as mocked:
+            trade1 = await broker.buy(hljh, 9.43, 1e5, bid_time)
+
+            mocked.side_effect = ConnectionError("redis is down")
+            await broker.flush_events()
+            self.assertEqual(1, len(broker._events))
+
+            mocked.side_effect = None
+            mocked.reset_mock()
+            await broker.info()
+            self.assertEqual(0, len(broker._events))
+            mocked.assert_called_once()
+            _, data = mocked.call_args.args
+            self.assertListEqual([trade1.tid], [e["buy"]["tid"] for e in data["batch"]])
+
     async def test_get_unclosed_trades(self):
         start = datetime.date(2022, 3, 1)
         end = datetime.date(2022, 3, 14)
@@ -259,6 +355,8 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
 
         self.assertEqual(0, len(broker.get_unclosed_trades(datetime.date(2022, 3, 3))))
 
+        bid_time = datetime.datetime(2022, 3, 3, 9, 31)
+        broker.trades[0] = Trade("01", hljh, 10, 500, 0.5, EntrustSide.BUY, bid_time)
         broker._update_unclosed_trades(0, datetime.date(2022, 3, 3))
         self.assertListEqual([0], broker.get_unclosed_trades(datetime.date(2022, 3, 3)))
 
@@ -278,6 +376,10 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
                 datetime.date(2022, 3, 10),
             ]
         ):
+            bid_time = datetime.datetime.combine(dt, datetime.time(9, 31))
+            broker.trades[i] = Trade(
+                "01", hljh, 10, 500, 0.5, EntrustSide.BUY, bid_time
+            )
             broker._update_unclosed_trades(i, dt)
 
         self.assertEqual(6, len(broker._unclosed_trades))
@@ -286,6 +388,49 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
             [0, 1, 2, 3], broker._unclosed_trades[datetime.date(2022, 3, 10)]
         )
 
+    async def test_unclosed_trades_by_security(self):
+        broker = Broker("test", 1e6, 1e-4, mar1, mar14)
+
+        t_tyst = await broker.buy(
+            tyst, 14.84, 500, datetime.datetime(2022, 3, 7, 9, 41)
+        )
+        t_hljh = await broker.buy(
+            hljh, 8.95, 1000, datetime.datetime(2022, 3, 9, 9, 40)
+        )
+
+        def assert_unclosed(dt, exp):
+            self.assertListEqual(
+                [tid for tids in exp.values() for tid in tids],
+                broker.get_unclosed_trades(dt),
+            )
+            self.assertDictEqual(exp, broker._unclosed_by_sec[dt])
+
+        assert_unclosed(mar7, {tyst: [t_tyst.tid]})
+        assert_unclosed(mar8, {tyst: [t_tyst.tid]})
+        assert_unclosed(mar9, {tyst: [t_tyst.tid], hljh: [t_hljh.tid]})
+        assert_unclosed(mar10, {tyst: [t_tyst.tid], hljh: [t_hljh.tid]})
+
+        # T+1: 当日买入的不可卖
+        bid_time = datetime.datetime(2022, 3, 9, 14, 0)
+        self.assertEqual(0, broker._get_sellable_shares(hljh, 1000, bid_time))
+        self.assertEqual(500, broker._get_sellable_shares(tyst, 500, bid_time))
+
+        bid_time = datetime.datetime(2022, 3, 10, 9, 33)
+        self.assertEqual(1000, broker._get_sellable_shares(hljh, 1000, bid_time))
+        self.assertEqual(500, broker._get_sellable_shares(tyst, 500, bid_time))
+
+        # 部分卖出，交易仍未平仓
+        await broker.sell(tyst, 12.98, 200, bid_time)
+        assert_unclosed(mar10, {tyst: [t_tyst.tid], hljh: [t_hljh.tid]})
+        self.assertEqual(300, broker._get_sellable_shares(tyst, 300, bid_time))
+
+        # 全部卖出，两个索引中都不再有该笔交易，而之前的日期不受影响
+        await broker.sell(tyst, 12.98, 300, bid_time)
+        assert_unclosed(mar10, {tyst: [], hljh: [t_hljh.tid]})
+        assert_unclosed(mar9, {tyst: [t_tyst.tid], hljh: [t_hljh.tid]})
+        self.assertEqual(0, broker._get_sellable_shares(tyst, 300, bid_time))
+        self.assertEqual(1000, broker._get_sellable_shares(hljh, 1000, bid_time))
+
     async def test_sell(self):
         start = datetime.date(2022, 3, 1)
         end = datetime.date(2022, 3, 14)
@@ -537,7 +682,7 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
                 np.testing.assert_array_almost_equal(exp[key], tyst_arr[key], 2)
             np.testing.assert_array_equal(exp["date"], tyst_arr["date"])
 
-            info = await broker.info()
+            await broker.info()
             self.assertAlmostEqual(1008979.2, info["assets"], 2)
             self.assertAlmostEqual(989580, info["available"], 2)
 
@@ -1007,6 +1152,40 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
 
         await broker._update_positions(trade, bid_time.date())
 
+    async def test_update_positions_after_forward(self):
+        broker = Broker("test", 1_000_000, 1e-4, mar1, mar14)
+        broker._positions = np.array(
+            [
+                (feb28, None, 0.0, 0.0, 0.0),
+                (mar1, hljh, 500.0, 0.0, 9.27),
+                (mar1, tyst, 1500.0, 0.0, 15.45),
+            ],
+            dtype=daily_position_dtype,
+        )
+
+        mocked_dr_info = pd.DataFrame(
+            {hljh: [1.0] * 3, tyst: [1.0] * 3}, index=[mar1, mar2, mar3]
+        )
+        with mock.patch(
+            "backtest.feed.zillionarefeed.ZillionareFeed.get_dr_factor",
+            return_value=mocked_dr_info,
+        ):
+            await broker._forward_positions(mar3)
+
+        # 补齐后在后一支证券上成交，只应更新它在当日的记录
+        bid_time = datetime.datetime(2022, 3, 3, 9, 31)
+        trade = Trade("01", tyst, 15.45, 500, 0.77, EntrustSide.BUY, bid_time)
+        await broker._update_positions(trade, mar3)
+
+        tyst_positions = broker._positions[broker._positions["security"] == tyst]
+        self.assertListEqual([mar1, mar2, mar3], tyst_positions["date"].tolist())
+        np.testing.assert_array_equal([1500, 1500, 2000], tyst_positions["shares"])
+        np.testing.assert_array_equal([0, 1500, 1500], tyst_positions["sellable"])
+
+        position = broker.get_position(mar3)
+        self.assertListEqual([hljh, tyst], position["security"].tolist())
+        np.testing.assert_array_equal([500, 2000], position["shares"])
+
     async def test_calendar_validation(self):
         start = datetime.date(2022, 3, 1)
         end = datetime.date(2022, 3, 14)
@@ -1179,6 +1358,40 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
                 np.testing.assert_almost_equal(exp_hljh[key], actual_hljh[key], 2)
                 np.testing.assert_almost_equal(exp_tyst[key], actual_tyst[key])
 
+    async def test_forward_positions_keeps_date_order(self):
+        broker = Broker("test", 1_000_000, 1e-4, mar1, mar14)
+        broker._positions = np.array(
+            [
+                (feb28, None, 0.0, 0.0, 0.0),
+                (mar1, hljh, 500.0, 0.0, 9.27),
+                (mar1, tyst, 1500.0, 0.0, 15.45),
+            ],
+            dtype=daily_position_dtype,
+        )
+
+        frames = [mar1, mar2, mar3, mar4]
+        mocked_dr_info = pd.DataFrame({hljh: [1.0] * 4, tyst: [1.0] * 4}, index=frames)
+
+        with mock.patch(
+            "backtest.feed.zillionarefeed.ZillionareFeed.get_dr_factor",
+            return_value=mocked_dr_info,
+        ):
+            await broker._forward_positions(mar4)
+
+        # 多支证券跨越多个交易日补齐后，持仓表仍按日期递增
+        dates = broker._positions["date"].tolist()
+        self.assertListEqual(sorted(dates), dates)
+
+        for dt in (mar2, mar3, mar4):
+            actual = broker._positions_on(dt)
+            self.assertListEqual([dt, dt], actual["date"].tolist())
+            self.assertListEqual([hljh, tyst], actual["security"].tolist())
+
+            position = broker.get_position(dt)
+            self.assertEqual(2, len(position))
+            np.testing.assert_array_equal([500, 1500], position["shares"])
+            np.testing.assert_array_equal([500, 1500], position["sellable"])
+
     @pytest.mark.skip(os.environ.get("IS_GITHUB"))
     async def test_issue_with_local_omicron(self):
         try:
@@ -1305,6 +1518,54 @@ class BrokerTest(unittest.IsolatedAsyncioTestCase):
                 [5000, 10000, 18000, 15000, 0, 0, 0, 0, 0, 0], mv.tolist()
             )
 
+    async def test_query_market_values_after_forward(self):
+        broker = Broker("test", 1_000_000, 1e-4, mar1, mar14)
+        broker._positions = np.array(
+            [
+                (feb28, None, 0.0, 0.0, 0.0),
+                (mar1, hljh, 500.0, 0.0, 9.27),
+                (mar1, tyst, 1500.0, 0.0, 15.45),
+            ],
+            dtype=daily_position_dtype,
+        )
+
+        mocked_dr_info = pd.DataFrame(
+            {hljh: [1.0] * 4, tyst: [1.0] * 4}, index=[mar1, mar2, mar3, mar4]
+        )
+        with mock.patch(
+            "backtest.feed.zillionarefeed.ZillionareFeed.get_dr_factor",
+            return_value=mocked_dr_info,
+        ):
+            await broker._forward_positions(mar4)
+
+        bars_dtype = [("frame", "datetime64[s]"), ("close", "<f4")]
+        hljh_bars = np.array([(mar2, 20), (mar3, 25)], dtype=bars_dtype)
+        tyst_bars = np.array([(mar2, 8), (mar3, 10)], dtype=bars_dtype)
+
+        # 单日查询，只应计入当日的持仓
+        with mock.patch(
+            "omicron.models.stock.Stock.batch_get_day_level_bars_in_range"
+        ) as mocked:
+            mocked.return_value.__aiter__.return_value = {
+                hljh: hljh_bars[1:],
+                tyst: tyst_bars[1:],
+            }.items()
+            mv = await broker._query_market_values(mar3, mar3)
+            self.assertListEqual([mar3], mv.index.tolist())
+            self.assertListEqual([27500], mv.tolist())
+
+        # 区间查询，不应包含区间之外的持仓
+        with mock.patch(
+            "omicron.models.stock.Stock.batch_get_day_level_bars_in_range"
+        ) as mocked:
+            mocked.return_value.__aiter__.return_value = {
+                hljh: hljh_bars,
+                tyst: tyst_bars,
+            }.items()
+            mv = await broker._query_market_values(mar2, mar3)
+            self.assertListEqual([mar2, mar3], mv.index.tolist())
+            self.assertListEqual([22000, 27500], mv.tolist())
+
     async def test_bills(self):
         start = datetime.date(2022, 3, 1)
         end = datetime.date(2022, 3, 14)
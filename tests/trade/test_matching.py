@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+
+from backtest.trade.matching import filter_bars, match_bid
+
+
+class MatchingTest(unittest.TestCase):
+    def test_filter_bars(self):
+        # 涨停价10.5，跌停价8.59
+        prices = np.array([10.5, 10.2, 9.8, 8.59, 10.5, 9.5], dtype=np.float32)
+
+        # 买入：去掉涨停和高于委托价的bar，并标记出跌停的bar
+        idx, at_opposite, all_limit = filter_bars(prices, 10.0, 1050, 859, True)
+        np.testing.assert_array_equal([2, 3, 5], idx)
+        np.testing.assert_array_equal([False, True, False], at_opposite)
+        self.assertFalse(all_limit)
+
+        # 卖出：去掉跌停和低于委托价的bar，并标记出涨停的bar
+        idx, at_opposite, all_limit = filter_bars(prices, 9.6, 859, 1050, False)
+        np.testing.assert_array_equal([0, 1, 2, 4], idx)
+        np.testing.assert_array_equal([True, False, False, True], at_opposite)
+        self.assertFalse(all_limit)
+
+        # 价格不满足，但并非全部涨停
+        idx, _, all_limit = filter_bars(prices, 8.0, 1050, 859, True)
+        self.assertEqual(0, idx.size)
+        self.assertFalse(all_limit)
+
+        # 全部bar都已涨停
+        prices = np.array([10.5, 10.5, 10.5], dtype=np.float32)
+        idx, at_opposite, all_limit = filter_bars(prices, 10.5, 1050, 859, True)
+        self.assertEqual(0, idx.size)
+        self.assertEqual(0, at_opposite.size)
+        self.assertTrue(all_limit)
+
+        # 全部bar都已跌停
+        prices = np.array([8.59, 8.59], dtype=np.float32)
+        idx, _, all_limit = filter_bars(prices, 8.59, 859, 1050, False)
+        self.assertEqual(0, idx.size)
+        self.assertTrue(all_limit)
+
+    def test_match_bid(self):
+        prices = np.array([9.0, 10.0, 11.0], dtype=np.float32)
+        volumes = np.array([100, 200, 300], dtype=np.float64)
+
+        # 部分成交：最后一个bar只成交剩余的部分
+        mean_price, filled, i = match_bid(prices, volumes, 200)
+        self.assertAlmostEqual((9.0 * 100 + 10.0 * 100) / 200, mean_price)
+        self.assertEqual(200, filled)
+        self.assertEqual(1, i)
+
+        # 刚好成交完前两个bar
+        mean_price, filled, i = match_bid(prices, volumes, 300)
+        self.assertAlmostEqual((9.0 * 100 + 10.0 * 200) / 300, mean_price)
+        self.assertEqual(300, filled)
+        self.assertEqual(1, i)
+
+        # 委托量超过总成交量，只能成交全部的量
+        mean_price, filled, i = match_bid(prices, volumes, 1000)
+        self.assertAlmostEqual((9.0 * 100 + 10.0 * 200 + 11.0 * 300) / 600, mean_price)
+        self.assertEqual(600, filled)
+        self.assertEqual(2, i)
+
+        with self.assertRaises(ValueError):
+            match_bid(
+                np.array([], dtype=np.float32), np.array([], dtype=np.float64), 100
+            )
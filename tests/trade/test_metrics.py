@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+from empyrical import (
+    annual_return,
+    annual_volatility,
+    calmar_ratio,
+    cum_returns_final,
+    max_drawdown,
+    sharpe_ratio,
+    sortino_ratio,
+)
+
+from backtest.trade.metrics import returns_metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def _check_with_empyrical(self, returns, rf=0.0, annual_days=252, rtol=1e-7):
+        (
+            mean_return,
+            cum_return,
+            win_rate,
+            sharpe,
+            sortino,
+            calmar,
+            mdd,
+            ar,
+            vr,
+        ) = returns_metrics(returns, rf, annual_days)
+
+        kwargs = {"annualization": annual_days}
+        np.testing.assert_allclose(np.mean(returns), mean_return, rtol=rtol)
+        np.testing.assert_allclose(cum_returns_final(returns), cum_return, rtol=rtol)
+        np.testing.assert_allclose(
+            np.count_nonzero(returns > 0) / len(returns), win_rate
+        )
+        np.testing.assert_allclose(
+            sharpe_ratio(returns, rf, **kwargs), sharpe, rtol=rtol
+        )
+        np.testing.assert_allclose(
+            sortino_ratio(returns, rf, **kwargs), sortino, rtol=rtol
+        )
+        np.testing.assert_allclose(calmar_ratio(returns, **kwargs), calmar, rtol=rtol)
+        np.testing.assert_allclose(max_drawdown(returns), mdd, rtol=rtol)
+        np.testing.assert_allclose(annual_return(returns, **kwargs), ar, rtol=rtol)
+        np.testing.assert_allclose(annual_volatility(returns, **kwargs), vr, rtol=rtol)
+
+    def test_returns_metrics(self):
+        rng = np.random.default_rng(78)
+        returns = rng.normal(0.001, 0.02, 250)
+
+        self._check_with_empyrical(returns)
+        self._check_with_empyrical(returns, rf=0.03 / 250, annual_days=250)
+        # float32的回报率在内部以float64累加，与empyrical（以float32计算）略有差异
+        self._check_with_empyrical(returns.astype(np.float32), rtol=1e-5)
+
+    def test_returns_metrics_edge_cases(self):
+        # 含有nan
+        returns = np.array([0.01, np.nan, -0.02, 0.03, -0.01, 0.005])
+        self._check_with_empyrical(returns)
+
+        # 只有一天
+        self._check_with_empyrical(np.array([0.01]))
+
+        # 一直上涨，没有回撤
+        self._check_with_empyrical(np.array([0.01, 0.02, 0.005]))
+
+        # 空序列
+        stats = returns_metrics(np.array([], dtype=np.float64), 0.0, 252)
+        self.assertTrue(all(np.isnan(v) for v in stats))